@@ -27,8 +27,15 @@ Outputs
 """
 import sys, numpy as np
 from pathlib import Path
+import io
+import mmap
 import re
 
+try:
+    from numba import njit
+except ImportError:      # numba is optional; main falls back to pure NumPy
+    njit = None
+
 # Terminal colors
 GREEN = "\033[32m"
 RESET = "\033[0m"
@@ -36,27 +43,61 @@ RESET = "\033[0m"
 # ─────────────────────────────────── POSCAR reader ───────────────────────────
 def read_poscar(fname):
     """Return (lattice 3×3 Å, fractional coords N×3, element list)"""
-    txt = Path(fname).read_text().splitlines()
-    scale   = float(txt[1])
-    lattice = np.array([[float(x) for x in ln.split()] for ln in txt[2:5]]) * scale
-    symbols = txt[5].split()
-    counts  = list(map(int, txt[6].split()))
-    natoms  = sum(counts)
-
-    ptr = 7
-    if txt[ptr][0].lower() == 's':   # Selective dynamics line
-        ptr += 1
-    cartesian = txt[ptr][0].lower() in ('c', 'k')
-    ptr += 1                         # now at first coord line
-
-    coords = np.array([[float(x) for x in txt[i].split()[:3]]
-                       for i in range(ptr, ptr + natoms)])
+    with open(fname, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            mm.readline()                        # comment line
+            scale   = float(mm.readline())
+            lattice = np.array([mm.readline().split() for _ in range(3)],
+                               dtype=np.float64) * scale
+            symbols = [s.decode() for s in mm.readline().split()]
+            counts  = list(map(int, mm.readline().split()))
+            natoms  = sum(counts)
+
+            line = mm.readline()
+            if line[:1].lower() == b's':         # Selective dynamics line
+                line = mm.readline()
+            cartesian = line[:1].lower() in (b'c', b'k')
+
+            # only the header is tokenized in Python; the coordinate block is
+            # parsed by np.loadtxt straight from the current file offset, so
+            # trailing velocity / predictor-corrector blocks are never touched
+            f.seek(mm.tell())
+            coords = np.loadtxt(f, max_rows=natoms, usecols=(0, 1, 2), ndmin=2)
+            # np.loadtxt silently returns short on a truncated file
+            if coords.shape[0] != natoms:
+                raise ValueError(f"expected {natoms} coordinate lines, "
+                                 f"got {coords.shape[0]}")
+        finally:
+            mm.close()
     if cartesian:
-        coords = coords @ np.linalg.inv(lattice)
+        # solve lattice.T @ x = coord per atom; cheaper and better
+        # conditioned than forming the explicit inverse
+        coords = np.linalg.solve(lattice.T, coords.T).T
 
     elements = np.repeat(symbols, counts)
     return lattice, coords, elements
 
+# ─────────────────────────────────── plane grouping ──────────────────────────
+if njit is not None:
+    # the explicit signature compiles at import time (and caches to disk),
+    # so the first call never stalls on the dispatcher in a one-shot script
+    @njit("int64[:](float64[:], float64)", cache=True)
+    def assign_planes(ps, tol):
+        """Streaming plane assignment over sorted projections.
+
+        A new plane starts whenever the gap to the previous projection
+        exceeds tol — one branch-predictable compare per atom. Compiled by
+        Numba, so the loop runs without Python dispatch.
+        """
+        ids = np.empty(ps.shape[0], np.int64)
+        k = 0
+        for i in range(ps.shape[0]):
+            if i > 0 and ps[i] - ps[i - 1] > tol:
+                k += 1
+            ids[i] = k
+        return ids
+
 # ─────────────────────────────────── helper -----------------------------------
 def ask(prompt, default=None, cast=str):
     tail = f" [{default}]" if default is not None else ""
@@ -100,9 +141,9 @@ def get_poscar_file():
             continue
 
         try:
-            # Try to read the file to validate it's a proper POSCAR
-            read_poscar(fname)
-            return fname
+            # Parse once: the result doubles as validation and is handed
+            # back so main does not read the file a second time
+            return fname, read_poscar(fname)
         except Exception as e:
             print(f"Error reading POSCAR file: {e}")
             continue
@@ -121,6 +162,10 @@ def get_orthogonal_vector():
             print(f"Error: {e}")
             continue
 
+# Index selections are whitespace-separated positive integers; one DFA scan
+# classifies the whole string instead of a per-token isdigit() loop
+_INDEX_RE = re.compile(r"\s*\d+(?:\s+\d+)*\s*$")
+
 def parse_atom_selection(atom_str, elems):
     """Parse atom selection string and return boolean mask"""
     natoms = len(elems)
@@ -129,16 +174,14 @@ def parse_atom_selection(atom_str, elems):
         return np.ones(natoms, bool)
 
     # Check if it's indices (all numeric)
-    parts = atom_str.split()
-    if all(part.isdigit() for part in parts):
-        idx = [int(x)-1 for x in parts]
+    if _INDEX_RE.match(atom_str):
+        idx = np.fromstring(atom_str, sep=" ", dtype=np.int64) - 1
         mask = np.zeros(natoms, bool)
         mask[idx] = True
         return mask
 
     # Otherwise treat as element symbols
-    keep = set(parts)
-    return np.array([e in keep for e in elems])
+    return np.isin(elems, atom_str.split())
 
 # ─────────────────────────────────── main -------------------------------------
 def main():
@@ -198,24 +241,27 @@ def main():
         sys.exit(1)
 
     # Get missing arguments interactively
+    poscar_data = None
     if poscar is None:
         print("Interactive mode - please provide the following inputs:")
-        poscar = get_poscar_file()
+        poscar, poscar_data = get_poscar_file()
 
     if n_vec is None:
         n_vec = get_orthogonal_vector()
 
-    # Read POSCAR file
-    try:
-        lattice, frac, elems = read_poscar(poscar)
-    except Exception as e:
-        print(f"Error reading POSCAR file: {e}")
-        sys.exit(1)
+    # Read POSCAR file (unless the interactive prompt already parsed it)
+    if poscar_data is None:
+        try:
+            poscar_data = read_poscar(poscar)
+        except Exception as e:
+            print(f"Error reading POSCAR file: {e}")
+            sys.exit(1)
+    lattice, frac, elems = poscar_data
 
     natoms = len(elems)
 
     # ---- choose atoms --------------------------------------------------------
-    print("\nElements present:", " ".join(sorted(set(elems))))
+    print("\nElements present:", " ".join(np.unique(elems).tolist()))
 
     if atoms is None:
         sel = input("Atoms of interest (symbols OR indices; blank = all): ").split()
@@ -225,7 +271,7 @@ def main():
             idx  = [int(x)-1 for x in sel]
             mask = np.zeros(natoms, bool); mask[idx] = True
         else:
-            keep = set(sel); mask = np.array([e in keep for e in elems])
+            mask = np.isin(elems, sel)
     else:
         try:
             mask = parse_atom_selection(atoms, elems)
@@ -248,63 +294,72 @@ def main():
     # ---- projections ---------------------------------------------------------
     n_cart = n_vec @ lattice if np.all(np.abs(n_vec) <= 1) else n_vec
     n_hat  = n_cart / np.linalg.norm(n_cart)
-    cart   = frac @ lattice
-    proj   = cart @ n_hat
-
-    planes = {}                                # plane_id → [ref_proj, [atom_idx]]
-    for i, p in enumerate(proj):
-        if not mask[i]:
-            continue
-        pid = next((k for k,(ref,_) in planes.items() if abs(p-ref)<tol), None)
-        if pid is None:
-            pid = len(planes); planes[pid] = [p, []]
-        planes[pid][1].append(i)
-
-    ordered = sorted(planes.items(), key=lambda kv: kv[1][0])
+    # (frac @ lattice) @ n_hat, associated to skip the N x 3 cartesian array
+    proj   = frac @ (lattice @ n_hat)
+
+    # Sort the selected projections once; a new plane starts wherever the gap
+    # between consecutive sorted projections exceeds tol, so assignment is a
+    # single compare per atom and planes come out already ordered.
+    sel_idx = np.flatnonzero(mask)
+    order   = np.argsort(proj[sel_idx], kind="stable")
+    sel_idx = sel_idx[order]
+    ps      = proj[sel_idx]
+    if njit is not None:
+        plane_ids = assign_planes(ps, tol)
+    else:
+        boundaries = np.zeros(ps.size, np.int64)
+        boundaries[1:] = np.diff(ps) > tol
+        plane_ids = np.cumsum(boundaries)
+    n_planes = int(plane_ids[-1]) + 1 if plane_ids.size else 0
 
     # ---- assign magnetic values & build MAGMOM array -------------------------
-    magmom_values = ["0"] * natoms  # Initialize as strings to handle P/N values
-    table_lines   = []
-    for plane_id, (_, idx_list) in enumerate(a[1] for a in ordered):
-        mag_val = P if (plane_id//L)%2 == 0 else N
-        for idx in idx_list:
-            magmom_values[idx] = str(mag_val)
-            fc = " ".join(f"{x:.3f}" for x in frac[idx])
-            table_lines.append(f"{idx+1:<10d} {elems[idx]:<7} {plane_id:<8d} {mag_val:<8} {fc}")
+    mag_vals = np.where((plane_ids // L) % 2 == 0, str(P), str(N))
+    magmom_values = np.full(natoms, "0", dtype=object)  # strings to handle P/N values
+    magmom_values[sel_idx] = mag_vals
+
+    # format the whole table in C: per-column np.char.mod, one np.savetxt
+    table_cols = np.column_stack([
+        np.char.mod("%-10d", sel_idx + 1),
+        np.char.mod("%-7s", elems[sel_idx]),
+        np.char.mod("%-8d", plane_ids),
+        np.char.mod("%-8s", mag_vals),
+        np.char.mod("%.3f", frac[sel_idx]),
+    ])
+    buf = io.StringIO()
+    np.savetxt(buf, table_cols, fmt="%s", delimiter=" ")
+    table_text = buf.getvalue()
 
     # ---- write MAGMOM file ---------------------------------------------------
+    # run-length encode consecutive equal values (VASP accepts "n*m" tokens)
+    run_start = np.concatenate(([True], magmom_values[1:] != magmom_values[:-1]))
+    starts = np.flatnonzero(run_start)
+    counts = np.diff(np.append(starts, natoms))
+    tokens = [f"{c}*{v}" if c > 1 else str(v)
+              for c, v in zip(counts.tolist(), magmom_values[starts].tolist())]
     with open("MAGMOM", "w") as f:
-        line = "MAGMOM = " + "  ".join(magmom_values)
-        f.write(line + "\n")
+        f.write("MAGMOM = " + " ".join(tokens) + "\n")
     print(f"\n{GREEN}Created MAGMOM file with {natoms} entries.{RESET}")
 
     # ---- write detailed table ------------------------------------------------
     with open("coplanar_atoms.txt", "w") as f:
-        f.write("atom_index element plane_ID magmom frac_coords\n")
-        f.write("-----------------------------------------------\n")
-        f.write("\n".join(table_lines) + "\n")
+        f.write("atom_index element plane_ID magmom frac_coords\n"
+                "-----------------------------------------------\n"
+                + table_text)
     print(f"{GREEN}Wrote detailed plane assignment to coplanar_atoms.txt{RESET}")
 
     # ---- save input parameters for reproducibility ---------------------------
     # Format atoms selection for command line
-    selected_atoms = []
     if np.all(mask):
         atoms_str = "all"
     else:
-        # Check if selection matches element-based selection
-        selected_elements = set()
-        for i, selected in enumerate(mask):
-            if selected:
-                selected_elements.add(elems[i])
-
         # If all atoms of certain elements are selected, use element names
-        element_mask = np.array([e in selected_elements for e in elems])
+        selected_elements = np.unique(elems[mask])
+        element_mask = np.isin(elems, selected_elements)
         if np.array_equal(mask, element_mask):
-            atoms_str = " ".join(sorted(selected_elements))
+            atoms_str = " ".join(selected_elements.tolist())
         else:
             # Otherwise use indices
-            indices = [str(i+1) for i, selected in enumerate(mask) if selected]
-            atoms_str = " ".join(indices)
+            atoms_str = " ".join((np.flatnonzero(mask) + 1).astype(str).tolist())
 
     # Format vector as [X,Y,Z]
     vector_str = f"[{n_vec[0]},{n_vec[1]},{n_vec[2]}]"
@@ -329,15 +384,15 @@ def main():
         f.write(f"# Positive block magnetic moment: {P}\n")
         f.write(f"# Negative block magnetic moment: {N}\n")
         f.write(f"# Total atoms processed: {np.sum(mask)}/{natoms}\n")
-        f.write(f"# Planes found: {len(ordered)}\n")
+        f.write(f"# Planes found: {n_planes}\n")
 
     print(f"{GREEN}Saved run parameters to run_parameters.txt{RESET}")
 
     # ---- also echo table to stdout ------------------------------------------
     print("\natom_index element plane_ID magmom frac_coords")
     print("-----------------------------------------------")
-    print("\n".join(table_lines))
-    print(f"\n{len(ordered)} planes found (tol={tol} Å). "
+    print(table_text, end="")
+    print(f"\n{n_planes} planes found (tol={tol} Å). "
           f"Magnetic moments alternate every {L} plane(s): {P}/{N}")
     print(f"\nTo reproduce this run, use:")
     print(f"{cmd_line}")